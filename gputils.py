@@ -2,10 +2,61 @@ import random
 import operator
 import math
 from deap import base, creator, gp, tools
-from robots import Robot
+from robots import Robots, DTYPE, DO_NOTHING, MOVE_DISTANCE, TURN_ANGLE, RELOAD_AMMO
 from tqdm import tqdm
 from graphviz import Digraph
 import functools
+import contextlib
+import multiprocessing
+import os
+import pickle
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+# CuPy is optional, only needed to run the battles on a GPU
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+
+# Robots start at least START_MARGIN away from the walls
+START_MARGIN = 50
+
+# Version of the battle cache files (see save_cache()), to be increased whenever the outcome of a battle
+# between two fingerprints changes in a way the header of the files does not record (e.g. rules in robots.py)
+CACHE_VERSION = 1
+
+
+def fingerprint_inputs(n=512, arena_size=200, seed=0):
+    """
+    Draws a fixed sample of n sensor readings (enemy_distance, enemy_direction, health, ammo, wall_distance)
+    that robots can actually sense in the arena, used to tell apart trees computing different functions:
+    - directions are uniform over their range, and so are distances in half of the readings, the other half
+      being packed close to 0 (cubed uniforms), where thresholds on distances matter most (in shooting range
+      or next to a wall);
+    - health is a multiple of 20 (hits take 20) and ammo an integer, both including their starting values,
+      where a quarter of the readings have full health and ammo (as at the start of every battle) and
+      another quarter have no ammo left.
+    The sample is of DTYPE, as the robots' sensors.
+    """
+
+    rng = np.random.default_rng(seed)
+    spread = np.where(np.arange(n) % 2, 3, 1)      # exponent of the uniforms the distances are drawn from
+    inputs = np.column_stack([
+        rng.uniform(0, 1, n) ** spread * arena_size * math.sqrt(2),
+        rng.uniform(0, 2 * math.pi, n),
+        20 * rng.integers(1, 6, n),
+        rng.integers(0, 51, n),
+        rng.uniform(0, 1, n) ** spread * arena_size / 2,
+    ]).astype(DTYPE)
+    inputs[:n//4, 2:4] = 100, 50
+    inputs[n//4:n//2, 3] = 0
+    return inputs
+
+
+FP_INPUTS = fingerprint_inputs()
 
 
 def create_primitive_set(ifelse, logicals, angle_primitives):
@@ -41,10 +92,7 @@ def create_primitive_set(ifelse, logicals, angle_primitives):
     pset.addPrimitive(min, 2)
     
     def protected_div(a, b):
-        try:
-            return a / b
-        except ZeroDivisionError:
-            return 1
+        return a / b if b else 1
     pset.addPrimitive(protected_div, 2)
 
     # Ephemeral constants
@@ -75,24 +123,160 @@ def create_primitive_set(ifelse, logicals, angle_primitives):
 
 
 
-def evaluate_individuals(pop1, pop2, toolbox, arena_size=200, max_steps=100):
+# Primitives written as Python operators in the generated source of a tree
+INLINE_PRIMITIVES = {
+    'add': '({} + {})',
+    'sub': '({} - {})',
+    'mul': '({} * {})',
+    'neg': '(-{})',
+}
+
+
+@functools.lru_cache(maxsize=None)
+def vector_primitives(xp=np):
+    """
+    Returns elementwise versions of the primitives in the array module xp (NumPy or CuPy), so that a compiled
+    tree runs on whole arrays of sensor values.
+    Arguments that are constants of the tree (Python numbers, when the other arguments are arrays) are made
+    arrays of DTYPE of the same module: CuPy does not mix them with its arrays everywhere (e.g. as the
+    condition of where), and comparisons and where of Python numbers would not be of DTYPE.
+    """
+
+    def asarray(a):
+        return xp.asarray(a, dtype=DTYPE) if isinstance(a, (int, float)) else a
+
+    def protected_div(a, b):
+        a, b = asarray(a), asarray(b)
+        zero = b == 0
+        return xp.where(zero, 1.0, a / xp.where(zero, 1.0, b))
+
+    return {
+        'add': xp.add,
+        'sub': xp.subtract,
+        'mul': xp.multiply,
+        'neg': xp.negative,
+        'max': lambda a, b: xp.maximum(asarray(a), asarray(b)),
+        'min': lambda a, b: xp.minimum(asarray(a), asarray(b)),
+        'protected_div': protected_div,
+        'if_then_else': lambda condition, out1, out2: xp.where(asarray(condition) != 0,
+                                                               asarray(out1), asarray(out2)),
+        'greater_than': lambda a, b: (asarray(a) > asarray(b)).astype(DTYPE),
+        'less_than': lambda a, b: (asarray(a) < asarray(b)).astype(DTYPE),
+        'sin': lambda a: xp.sin(asarray(a)),
+        'cos': lambda a: xp.cos(asarray(a)),
+    }
+
+
+def to_postfix(expr):
+    """
+    Flattens a tree into postfix code, a list of (token, arity) pairs where the token is the primitive's
+    name or the terminal's source. DEAP stores trees in prefix order, so this is the reversed tree.
+    """
+
+    return [(node.name, node.arity) if node.arity else (node.format(), 0) for node in reversed(expr)]
+
+
+def tree_source(expr, pset):
+    """
+    Generates the source of a Python function of the sensor inputs computing a tree, which accepts either
+    numbers or NumPy arrays (one element per robot). Being plain text, the source can be sent to worker
+    processes.
+
+    Unlike gp.compile, which evaluates the tree string as a lambda, the postfix code of the tree is turned
+    into straight-line source, one local variable per primitive:
+    - arithmetic primitives become plain operators (no function call per node), the other primitives
+      are called from vector_primitives();
+    - repeated subtrees are computed once;
+    - subtrees without inputs are folded into constants.
+    """
+
+    code = getattr(expr, '_postfix', None)
+    if code is None:
+        code = expr._postfix = to_postfix(expr)
+
+    lines, stack, subtrees, constants = [], [], {}, set()
+    for token, arity in code:
+        if not arity:
+            stack.append(token)
+            if token not in pset.arguments:
+                constants.add(token)
+            continue
+
+        args = [stack.pop() for _ in range(arity)]     # the first argument was pushed last
+        if token in INLINE_PRIMITIVES:
+            value = INLINE_PRIMITIVES[token].format(*args)
+        else:
+            value = '{}({})'.format(token, ', '.join(args))
+
+        if all(arg in constants for arg in args):
+            try:
+                folded = eval(value, pset.context, {})
+            except (ArithmeticError, ValueError):
+                folded = None
+            if isinstance(folded, int) or isinstance(folded, float) and math.isfinite(folded):
+                stack.append(repr(folded))
+                constants.add(stack[-1])
+                continue
+
+        if value not in subtrees:
+            subtrees[value] = 't{}'.format(len(subtrees))
+            lines.append('    {} = {}'.format(subtrees[value], value))
+        stack.append(subtrees[value])
+
+    return 'def program({}):\n{}\n    return {}\n'.format(', '.join(pset.arguments), '\n'.join(lines), stack[0])
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_source(source, xp=np):
+    """
+    Compiles the source of a program generated by tree_source(), for arrays of the array module xp.
+    Identical trees share the compiled function.
+    """
+
+    namespace = dict(vector_primitives(xp))
+    exec(source, namespace)
+
+    return namespace['program']
+
+
+
+
+def evaluate_individuals(pop1, pop2, toolbox, arena_size=200, max_steps=100, cache=None, chunks=1, device='cpu'):
     """
     Evaluates fitness by pitting individuals from pop1 against individuals from pop2, where
     each robot executes its GP-evolved strategy using its sensors.
 
-    At every time step:
+    All the battles are run together by run_battles(). At every time step:
     - Sensor values are updated.
     - Output from GP tree is computed.
     - Output is mapped to one of six possible actions.
     - Robots act (move, shoot, etc.).
     - If a robot's health <= 0, the match ends.
+    - If a step changes nothing (e.g. both robots do nothing), the match ends as it would be stuck.
 
     Fitness is increased by 1 if an individual defeats its opponent, where defeat is considered valid only if
     the opponent dies and the winner survives.
     If both robots survive or both die, no change to fitness.
+
+    Individuals with a valid fitness (e.g. clones that went through selection unchanged) keep it, and only
+    fight the new individuals (without a valid fitness) of the other population: their matchups against each
+    other were already counted.
+
+    If a cache (OrderedDict) is given, battle outcomes are stored in it and reused whenever a pair of trees
+    with the same fingerprints (see fingerprint()) meets again, so a cache must only be used with one
+    arena_size and max_steps (see cache_header() for the caches stored on disk). Starting positions and
+    facings are drawn from an RNG seeded with the pair's key, so a cached outcome is the one the battle would
+    have produced as long as the fingerprints tell the trees apart (fingerprints are an approximation, see
+    fingerprint()).
+    The cache is kept to the 10 * len(pop1) * len(pop2) most recently used pairs.
+
+    The battles are split into the given number of chunks, which are run through toolbox.map (e.g. the map of
+    a multiprocessing pool), on the given device (see array_module()).
     """
 
     # Fitness initialization for new population
+    new1 = [not ind1.fitness.valid for ind1 in pop1]
+    new2 = [not ind2.fitness.valid for ind2 in pop2]
     for ind1 in pop1:
         if not ind1.fitness.valid:
             ind1.fitness.values = (0,)
@@ -101,94 +285,266 @@ def evaluate_individuals(pop1, pop2, toolbox, arena_size=200, max_steps=100):
         if not ind2.fitness.valid:
             ind2.fitness.values = (0,)
     
-    # Competition loop
-    for ind1 in pop1:
-        for ind2 in pop2:
-
-            # Create robots
-            robot1 = Robot(random.uniform(50, arena_size-50), 
-                          random.uniform(50, arena_size-50))
-            robot2 = Robot(random.uniform(50, arena_size-50), 
-                          random.uniform(50, arena_size-50))
-            
-            # Compile the individual programs
-            func1 = toolbox.compile(expr=ind1)
-            func2 = toolbox.compile(expr=ind2)
-            
-            # At each step of the battle:
-            for _ in range(max_steps):
-                
-                # 1) Update sensors
-                robot1.update_sensors(robot2, arena_size)
-                robot2.update_sensors(robot1, arena_size)
-                
-                # 2) Get outputs from GP trees
-                output1 = func1(
-                    robot1.sensors['enemy_distance'],
-                    robot1.sensors['enemy_direction'],
-                    robot1.sensors['health'],
-                    robot1.sensors['ammo'],
-                    robot1.sensors['wall_distance']
-                )
-                output2 = func2(
-                    robot2.sensors['enemy_distance'],
-                    robot2.sensors['enemy_direction'],
-                    robot2.sensors['health'],
-                    robot2.sensors['ammo'],
-                    robot2.sensors['wall_distance']
-                )
-                
-                # 3) Map output to actions
-                action1 = select_action(output1)
-                action2 = select_action(output2)
-                
-                # 4) Execute actions
-                robot1.execute_action(action1, robot2, arena_size)
-                robot2.execute_action(action2, robot1, arena_size)
-                
-                # 5) Check if battle is over
-                if robot1.health <= 0 or robot2.health <= 0:
-                    break
-            
+    # Pairings (involving at least one new individual), and the battles that actually have to be fought
+    # (once per key)
+    if cache is not None:
+        keys = [[(fingerprint(ind1, toolbox), fingerprint(ind2, toolbox)) for ind2 in pop2] for ind1 in pop1]
+    else:
+        keys = [[(i, j) for j in range(len(pop2))] for i in range(len(pop1))]
+
+    battles = {}
+    for ind1, is_new1, row in zip(pop1, new1, keys):
+        for ind2, is_new2, key in zip(pop2, new2, row):
+            if not (is_new1 or is_new2):
+                continue
+            if (cache is None or key not in cache) and key not in battles:
+                battles[key] = (ind1, ind2)
+
+    # Competition, in contiguous chunks of battles (each program is compiled once, not once per opponent)
+    sources1 = [toolbox.source(expr=ind1) for ind1, _ in battles.values()]
+    sources2 = [toolbox.source(expr=ind2) for _, ind2 in battles.values()]
+    starts = battle_starts([hash(key) for key in battles] if cache is not None else len(battles), arena_size)
+
+    bounds = np.linspace(0, len(battles), chunks + 1).astype(int)
+    battle_chunks = [(sources1[a:b], sources2[a:b], starts[a:b], arena_size, max_steps, device)
+                     for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+    wins1, wins2 = [], []
+    for chunk_wins1, chunk_wins2 in toolbox.map(run_battle_chunk, battle_chunks):
+        wins1 += chunk_wins1.tolist()
+        wins2 += chunk_wins2.tolist()
+    outcomes = dict(zip(battles, zip(wins1, wins2)))
+
+    for ind1, is_new1, row in zip(pop1, new1, keys):
+        for ind2, is_new2, key in zip(pop2, new2, row):
+            if not (is_new1 or is_new2):
+                continue
+            if key in outcomes:
+                outcome = outcomes[key]
+                if cache is not None:
+                    cache[key] = outcome
+            else:
+                cache.move_to_end(key)
+                outcome = cache[key]
+
             # Fitness update based on battle outcome
-            if robot1.health > 0 and robot2.health <= 0:
+            if outcome[0]:
                 ind1.fitness.values = (ind1.fitness.values[0] + 1,)
-            elif robot2.health > 0 and robot1.health <= 0:
+            elif outcome[1]:
                 ind2.fitness.values = (ind2.fitness.values[0] + 1,)
-            
+
+    # Least recently used pairs are dropped first
+    if cache is not None:
+        while len(cache) > 10 * len(pop1) * len(pop2):
+            cache.popitem(last=False)
 
 
 
-def select_action(output):
+
+def battle_starts(seeds, arena_size=200):
+    """
+    Draws the starting positions and facings (x1, y1, direction1, x2, y2, direction2) of the battles at once.
+    - seeds: a list of integer seeds, one per battle, each always giving the same start; or the number of
+      battles, drawn from a generator seeded by the random module (so that random.seed() still applies).
     """
-    Converts numeric output of the GP tree to one of 6 discrete actions:
 
-    `move_forward`, `turn_left`, `turn_right`, `shoot`, `reload`, `do_nothing`
+    if isinstance(seeds, int):
+        uniforms = np.random.default_rng(random.getrandbits(64)).random((seeds, 6))
+    else:
+        uniforms = seeded_uniforms(seeds, 6)
+    near, far = START_MARGIN, arena_size - START_MARGIN
+    low = np.array([near, near, 0, near, near, 0])
+    high = np.array([far, far, 2 * math.pi, far, far, 2 * math.pi])
+    return low + (high - low) * uniforms
+
+
+def seeded_uniforms(seeds, size):
+    """
+    Returns a (len(seeds), size) array of uniforms in [0, 1), row i depending only on seeds[i]: the splitmix64
+    hash of the counters seed + k * golden gamma (k = 1..size), computed for all seeds at once.
+    """
+
+    seeds = np.array([seed % 2**64 for seed in seeds], dtype=np.uint64).reshape(-1, 1)
+    z = seeds + np.arange(1, size + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)) * 2.0**-53
+
+
+def array_module(device):
     """
- 
-    action_num = int(abs(output)) % 6
+    Returns the array module the battles are run with: NumPy for device 'cpu', CuPy for device 'gpu'.
+    """
+
+    if device == 'cpu':
+        return np
+    if device == 'gpu':
+        if cupy is None:
+            raise ImportError("device='gpu' requires CuPy")
+        return cupy
+    raise ValueError(f'Unknown device {device!r}')
+
+
+def run_battle_chunk(chunk):
+    """
+    Runs run_battles() on a tuple of its arguments, for use with toolbox.map.
+    """
+
+    return run_battles(*chunk)
+
+
+def run_battles(sources1, sources2, starts, arena_size=200, max_steps=100, device='cpu'):
+    """
+    Runs the battles between the programs of sources1[i] and sources2[i] (see tree_source()) side by side,
+    each battle being a slot of two Robots batches, starting from starts[i] (see battle_starts()).
+
+    On device 'gpu' the batches live in GPU memory, and the programs are compiled for CuPy arrays
+    (experimental: this path has not been tested on a GPU yet).
+
+    Returns the outcomes as two boolean arrays (robot1 wins, robot2 wins).
+    """
+
+    xp = array_module(device)
+
+    # Create robots
+    x1, y1, dir1, x2, y2, dir2 = xp.asarray(starts).T
+    robots1 = Robots(x1, y1, dir1, xp=xp)
+    robots2 = Robots(x2, y2, dir2, xp=xp)
+
+    # Slots of each program, so that a program runs once per step on all its battles
+    groups1 = program_slots(sources1, xp)
+    groups2 = program_slots(sources2, xp)
+
+    # Battles still going on
+    active = xp.ones(len(sources1), dtype=bool)
+    output1 = xp.zeros(len(sources1), dtype=DTYPE)
+    output2 = xp.zeros(len(sources2), dtype=DTYPE)
     
-    actions = [
-        'move_forward',
-        'turn_left',
-        'turn_right',
-        'shoot',
-        'reload',
-        'do_nothing'
-    ]
+    # At each step of the battles:
+    for _ in range(max_steps):
+        
+        # 1) Update sensors
+        robots1.update_sensors(robots2, arena_size)
+        robots2.update_sensors(robots1, arena_size)
+        
+        # 2) Get outputs from GP trees (arithmetic errors give inf/nan, i.e. do_nothing)
+        with np.errstate(all='ignore'):
+            run_programs(groups1, robots1, active, output1)
+            run_programs(groups2, robots2, active, output2)
+        
+        # 3) Map output to actions (finished battles are frozen)
+        action1 = xp.where(active, select_action(output1, xp), DO_NOTHING)
+        action2 = xp.where(active, select_action(output2, xp), DO_NOTHING)
+        
+        # 4) Execute actions
+        changed1 = robots1.execute_action(action1, robots2, arena_size)
+        changed2 = robots2.execute_action(action2, robots1, arena_size)
+        
+        # 5) Check which battles are over. Programs are deterministic, so a battle in which neither robot
+        # changed anything would repeat the same step until the end: both robots survive.
+        active &= (robots1.health > 0) & (robots2.health > 0) & (changed1 | changed2)
+        if not active.any():
+            break
     
-    return actions[action_num]
+    return ((robots1.health > 0) & (robots2.health <= 0),
+            (robots2.health > 0) & (robots1.health <= 0))
+
+
+
+
+def program_slots(sources, xp=np):
+    """
+    Groups the slots of a list of program sources by program, as (compiled program, slot indices) pairs,
+    the indices being an array of the array module xp.
+    """
+
+    slots = {}
+    for i, source in enumerate(sources):
+        slots.setdefault(source, []).append(i)
+    return [(compile_source(source, xp), xp.asarray(indices)) for source, indices in slots.items()]
+
+
+def run_programs(groups, robots, active, output):
+    """
+    Runs each program of groups (see program_slots()) on the sensors of its slots in a Robots batch, writing
+    the results into output. Programs whose battles are all over are skipped.
+    """
+
+    for func, slots in groups:
+        if active[slots].any():
+            output[slots] = func(
+                robots.enemy_distance[slots],
+                robots.enemy_direction[slots],
+                robots.health[slots],
+                robots.ammo[slots],
+                robots.wall_distance[slots]
+            )
+
+
+
+
+def fingerprint(individual, toolbox):
+    """
+    Hashes the outputs of an individual's program on the fixed FP_INPUTS sample (see fingerprint_inputs()),
+    so that syntactically different but equivalent trees (e.g. add(x, 0) and x, or trees with dead subtrees)
+    share a key. Non-finite outputs all lead to `do_nothing`, so they are hashed alike.
+    This is an approximation: trees that agree on the whole sample but not on some other sensor readings
+    (e.g. comparing a distance to a threshold that no reading falls between) still share a key.
+    """
+
+    fp = getattr(individual, '_fingerprint', None)
+    if fp is None:
+        func = toolbox.compile(expr=individual)
+        with np.errstate(all='ignore'):
+            outputs = np.broadcast_to(func(*FP_INPUTS.T), len(FP_INPUTS)).round(4)
+        fp = individual._fingerprint = hash(tuple(np.where(np.isfinite(outputs), outputs, np.inf).tolist()))
+    return fp
+
+
+
+
+def select_action(output, xp=np):
+    """
+    Converts numeric outputs of GP trees (an array of the array module xp) to the codes of 6 discrete actions,
+    i.e. indices of robots.ACTIONS:
+
+    `move_forward`, `turn_left`, `turn_right`, `shoot`, `reload`, `do_nothing`
+
+    The code is int(abs(output)) % 6, computed with fmod so that huge outputs do not overflow;
+    non-finite outputs map to `do_nothing`.
+    """
+
+    with np.errstate(invalid='ignore'):
+        action_num = xp.fmod(xp.abs(output), 6)
+
+    # do_nothing is the last code, so capping with fmin (which drops NaNs) leaves the valid codes
+    # unchanged and turns the NaNs of non-finite outputs into do_nothing
+    return xp.fmin(action_num, DO_NOTHING).astype(int)
 
 
 
 
-def setup_evolution(pset):
+def invalidate(individual):
+    """
+    Drops the fitness and every value cached on an individual whose tree has just been modified.
+    """
+
+    del individual.fitness.values
+    individual._postfix = None
+    individual._source = None
+    individual._fingerprint = None
+
+
+
+
+def setup_evolution(pset, max_height=10):
     """
     Configures the evolution parameters with:
     - Fitness and individual types (creator).
     - Population creation tools.
     - Crossover (one-point).
     - Mutation (uniform with subtree replacement).
+    - Bloat control (offspring taller than max_height are replaced by one of their parents).
     - Selection (tournament).
     """
 
@@ -203,7 +559,20 @@ def setup_evolution(pset):
     toolbox.register('expr', gp.genHalfAndHalf, pset=pset, min_=3, max_=5)
     toolbox.register('individual', tools.initIterate, creator.Individual, toolbox.expr)
     toolbox.register('population', tools.initRepeat, list, toolbox.individual)
-    toolbox.register('compile', gp.compile, pset=pset)
+
+    # The program's source is stored on the individual (clones share it, crossover and mutation must reset it
+    # through invalidate()), and compile_source() shares the compiled function between identical sources; the
+    # function itself is not stored, so that individuals can still be pickled
+    def source_cached(expr):
+        source = getattr(expr, '_source', None)
+        if source is None:
+            source = expr._source = tree_source(expr, pset)
+        return source
+    toolbox.register('source', source_cached)
+
+    def compile_cached(expr):
+        return compile_source(source_cached(expr))
+    toolbox.register('compile', compile_cached)
     
     # One-point crossover
     toolbox.register('mate', gp.cxOnePoint)
@@ -211,6 +580,10 @@ def setup_evolution(pset):
     # Uniform mutation w/ subtree replacement (between 0 and 2)
     toolbox.register('expr_mut', gp.genFull, min_=0, max_=2)
     toolbox.register('mutate', gp.mutUniform, expr=toolbox.expr_mut, pset=pset)
+
+    # Bloat control, so that the cost of running a program stays bounded over the generations
+    toolbox.decorate('mate', gp.staticLimit(key=operator.attrgetter('height'), max_value=max_height))
+    toolbox.decorate('mutate', gp.staticLimit(key=operator.attrgetter('height'), max_value=max_height))
     
     # Tournament selection
     toolbox.register('select', tools.selTournament, tournsize=3)
@@ -220,12 +593,13 @@ def setup_evolution(pset):
 
 
 
-def coevolution(pop_size=30, generations=20, ifelse=False, logicals=False, angle_primitives=False):
+def coevolution(pop_size=30, generations=20, ifelse=False, logicals=False, angle_primitives=False, processes=1,
+                device='cpu', cache_path=None):
     """
     Runs the co-evolutionary algorithm.
 
     - Create two populations (pop1, pop2) with randomly initialized individuals.
-    - Evaluate all individuals using evaluate_individuals().
+    - Evaluate all individuals using evaluate_individuals(), caching battle outcomes across generations.
     - For each generation:
         - Select, clone, and apply crossover/mutation.
         - Re-evaluate the new individuals.
@@ -236,71 +610,131 @@ def coevolution(pop_size=30, generations=20, ifelse=False, logicals=False, angle
     - ifelse (default False): adds conditional operator to primitives
     - logicals (default False): adds "<" and ">" operators to primitives
     - angle_primitives (default False): adds sin, cos operators and ephemeral constant (-pi, pi)
+    - processes (default 1): number of worker processes the battles are spread over (None for all cores)
+    - device (default 'cpu'): 'gpu' runs the battles on a GPU, with CuPy (only with processes=1; experimental,
+      not tested on a GPU yet)
+    - cache_path (default None): file the battle outcomes are loaded from and saved to, so that they are
+      reused across runs (and processes), as long as they were stored under the same rules (see cache_header()).
     """
 
+    if device == 'gpu' and processes != 1:
+        raise ValueError('The GPU cannot be shared by worker processes, use processes=1 with device=\'gpu\'')
+
     pset = create_primitive_set(ifelse, logicals, angle_primitives)
     toolbox = setup_evolution(pset)
     
-    # Populations with initial evaluation
-    pop1 = toolbox.population(n=pop_size)
-    pop2 = toolbox.population(n=pop_size)
-    evaluate_individuals(pop1, pop2, toolbox)
-
-    # For logging/visualizing
-    avg_fits1, max_fits1 = [], []
-    avg_fits2, max_fits2 = [], []
+    # Worker processes for the battles, one chunk of battles each
+    with (multiprocessing.Pool(processes) if processes != 1 else contextlib.nullcontext()) as pool:
+        if pool is not None:
+            toolbox.register('map', pool.map)
+        chunks = 1 if pool is None else processes or os.cpu_count()
+
+        # Populations with initial evaluation
+        pop1 = toolbox.population(n=pop_size)
+        pop2 = toolbox.population(n=pop_size)
+
+        # Battle outcomes, shared by all generations (and runs, if stored)
+        battle_cache = load_cache(cache_path) if cache_path is not None else OrderedDict()
+        evaluate_individuals(pop1, pop2, toolbox, cache=battle_cache, chunks=chunks, device=device)
+
+        # For logging/visualizing
+        avg_fits1, max_fits1 = [], []
+        avg_fits2, max_fits2 = [], []
     
-    # Evolutionary loop
-    for gen in tqdm(range(generations), unit=' generation'):
+        # Evolutionary loop
+        for gen in tqdm(range(generations), unit=' generation'):
 
-        # Select parents with tournament selection (same population size)
-        offspring1 = toolbox.select(pop1, len(pop1))
-        offspring2 = toolbox.select(pop2, len(pop2))
+            # Select parents with tournament selection (same population size)
+            offspring1 = toolbox.select(pop1, len(pop1))
+            offspring2 = toolbox.select(pop2, len(pop2))
         
-        # Create a deepcopy of the parents to perform crossover and mutation on
-        offspring1 = [toolbox.clone(ind) for ind in offspring1]
-        offspring2 = [toolbox.clone(ind) for ind in offspring2]
+            # Create a deepcopy of the parents to perform crossover and mutation on
+            offspring1 = [toolbox.clone(ind) for ind in offspring1]
+            offspring2 = [toolbox.clone(ind) for ind in offspring2]
         
-        # Crossover with 50% probability between pairs of ordered individuals (e.g. 0&1, 2&3, 4&5 etc.)
-        for child1, child2 in zip(offspring1[::2], offspring1[1::2]):
-            if random.random() < 0.5:
-                toolbox.mate(child1, child2)
-                del child1.fitness.values
-                del child2.fitness.values
+            # Crossover with 50% probability between pairs of ordered individuals (e.g. 0&1, 2&3, 4&5 etc.)
+            # (the offspring returned by the operators are kept, as bloat control may replace them)
+            for offspring in (offspring1, offspring2):
+                for i in range(1, len(offspring), 2):
+                    if random.random() < 0.5:
+                        offspring[i - 1], offspring[i] = toolbox.mate(offspring[i - 1], offspring[i])
+                        invalidate(offspring[i - 1])
+                        invalidate(offspring[i])
         
-        for child1, child2 in zip(offspring2[::2], offspring2[1::2]):
-            if random.random() < 0.5:
-                toolbox.mate(child1, child2)
-                del child1.fitness.values
-                del child2.fitness.values
+            # Mutation (uniform subtree replacement) with 10% probability
+            for offspring in (offspring1, offspring2):
+                for i in range(len(offspring)):
+                    if random.random() < 0.1:
+                        offspring[i], = toolbox.mutate(offspring[i])
+                        invalidate(offspring[i])
         
-        # Mutation (uniform subtree replacement) with 10% probability
-        for mutant in offspring1:
-            if random.random() < 0.1:
-                toolbox.mutate(mutant)
-                del mutant.fitness.values
+            # Evaluate the new individuals and replace the old population
+            evaluate_individuals(offspring1, offspring2, toolbox, cache=battle_cache, chunks=chunks, device=device)
+            pop1[:] = offspring1
+            pop2[:] = offspring2
         
-        for mutant in offspring2:
-            if random.random() < 0.1:
-                toolbox.mutate(mutant)
-                del mutant.fitness.values
-        
-        # Evaluate the new individuals and replace the old population
-        evaluate_individuals(offspring1, offspring2, toolbox)
-        pop1[:] = offspring1
-        pop2[:] = offspring2
-        
-        # Fitness
-        fits1 = [ind.fitness.values[0] for ind in pop1]
-        fits2 = [ind.fitness.values[0] for ind in pop2]
+            # Fitness
+            fits1 = [ind.fitness.values[0] for ind in pop1]
+            fits2 = [ind.fitness.values[0] for ind in pop2]
 
-        avg_fits1.append(sum(fits1) / len(fits1))
-        max_fits1.append(max(fits1))
+            avg_fits1.append(sum(fits1) / len(fits1))
+            max_fits1.append(max(fits1))
 
-        avg_fits2.append(sum(fits2) / len(fits2))
-        max_fits2.append(max(fits2))
+            avg_fits2.append(sum(fits2) / len(fits2))
+            max_fits2.append(max(fits2))
+
+        if cache_path is not None:
+            save_cache(battle_cache, cache_path)
     
-    return pop1, pop2, avg_fits1, max_fits1, avg_fits2, max_fits2
+        return pop1, pop2, avg_fits1, max_fits1, avg_fits2, max_fits2
+
+
+
+
+def cache_header(arena_size=200, max_steps=100):
+    """
+    Returns what the outcomes of a battle cache depend on besides the fingerprints of the trees: the
+    CACHE_VERSION, a digest of FP_INPUTS (the fingerprints), the arena, the number of steps, the precision
+    of the robots, the starting ranges and the effects of the actions.
+    """
+
+    digest = hashlib.sha256()
+    for table in (FP_INPUTS, MOVE_DISTANCE, TURN_ANGLE, RELOAD_AMMO):
+        digest.update(table.tobytes())
+    return {
+        'version': CACHE_VERSION,
+        'digest': digest.hexdigest(),
+        'arena_size': arena_size,
+        'max_steps': max_steps,
+        'dtype': np.dtype(DTYPE).str,
+        'start_margin': START_MARGIN,
+    }
+
+
+def load_cache(path, arena_size=200, max_steps=100):
+    """
+    Loads a battle cache saved by save_cache(), or returns an empty one if the file does not exist or was
+    saved under a different header (see cache_header()).
+    """
+
+    if not os.path.exists(path):
+        return OrderedDict()
+    with open(path, 'rb') as f:
+        saved = pickle.load(f)
+    if not isinstance(saved, tuple) or saved[0] != cache_header(arena_size, max_steps):
+        return OrderedDict()
+    return saved[1]
+
+
+def save_cache(cache, path, arena_size=200, max_steps=100):
+    """
+    Saves a battle cache to a file, along with the header of the battles it holds (see cache_header()),
+    replacing the file only once fully written.
+    """
+
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump((cache_header(arena_size, max_steps), cache), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
 
 
 
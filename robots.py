@@ -1,99 +1,155 @@
-import random
 import math
+import numpy as np
 
-class Robot:
+
+# Actions, and their codes as returned by select_action()
+ACTIONS = ('move_forward', 'turn_left', 'turn_right', 'shoot', 'reload', 'do_nothing')
+MOVE_FORWARD, TURN_LEFT, TURN_RIGHT, SHOOT, RELOAD, DO_NOTHING = range(len(ACTIONS))
+
+# Precision of the robots' state: single precision is plenty for the arena's physics, and halves the memory
+# traffic of every step (Python number constants do not upcast float32 arrays)
+DTYPE = np.float32
+
+TWO_PI = 2 * math.pi
+
+# Effects of each action, indexed by action code
+MOVE_DISTANCE = np.array([5, 0, 0, 0, 0, 0], dtype=DTYPE)
+TURN_ANGLE = np.array([0, -math.pi/8, math.pi/8, 0, 0, 0], dtype=DTYPE)      # turn left/right by 22.5 degrees
+RELOAD_AMMO = np.array([0, 0, 0, 0, 10, 0], dtype=DTYPE)
+
+
+class Robots:
     """
-    Defines a robot agent in a 2D arena. 
+    Defines a batch of robot agents in a 2D arena, stored as a struct of arrays: slot i of every
+    attribute belongs to the robot fighting the i-th battle, so that all battles are stepped at once.
+    The arrays (of DTYPE) are created with the array module xp, NumPy by default or CuPy to keep them on a GPU.
 
     Attributes
-    - x, y: position
+    - x, y: positions
     - health: starts at 100, decreases when hit
     - ammo: starts at 50, consumed by shooting
-    - direction: angle in radians.
-    - sensors: dictionary of input values for decision-making.
+    - direction: angles in radians.
+    - cos_direction, sin_direction: cosines and sines of the directions, only updated when robots turn.
+    - last_action: action codes of the last step.
+    - moved: whether any robot of the batch moved since the last sensor update.
+    - effects: MOVE_DISTANCE, TURN_ANGLE, RELOAD_AMMO tables in the array module.
+    - enemy_distance, enemy_direction, wall_distance: sensors (along with health and ammo) used
+      for decision-making.
 
     Methods
+    - relative_angle(angle): angles relative to the robots' directions, in [0, 2pi).
     - update_sensors(opponent, arena_size): calculates
         - Distance and direction to enemy.
         - Wall proximity.
-        - Own health and ammo.
+      (own health and ammo are read directly from the attributes)
     - execute_action(action, opponent, arena_size):
-        - Applies either movement, turning, shooting, reloading, or does nothing.
+        - Applies either movement, turning, shooting, reloading, or does nothing, according to
+          the action code of each slot.
+        - Returns a boolean array of the slots where the action changed anything (a blocked move,
+          a shot without ammo or a reload with full ammo do not).
     """
 
-    def __init__(self, x, y, health=100, ammo=50):
-        self.x = x
-        self.y = y
-        self.health = health
-        self.ammo = ammo
-        self.direction = random.uniform(0, 2 * math.pi) # the facing is random
-        self.last_action = None
-        self.sensors = {
-            'enemy_distance': 0,
-            'enemy_direction': 0,
-            'health': 100,
-            'ammo': 50,
-            'wall_distance': 0
-        }
-    
+    __slots__ = ('xp', 'effects', 'x', 'y', 'health', 'ammo', 'direction', 'cos_direction', 'sin_direction',
+                 'last_action', 'moved', 'enemy_distance', 'enemy_direction', 'wall_distance')
+
+    def __init__(self, x, y, direction, health=100, ammo=50, xp=np):
+        self.xp = xp
+        self.effects = tuple(xp.asarray(table) for table in (MOVE_DISTANCE, TURN_ANGLE, RELOAD_AMMO))
+        self.x = xp.asarray(x, dtype=DTYPE)
+        self.y = xp.asarray(y, dtype=DTYPE)
+        self.health = xp.full(self.x.shape, health, dtype=DTYPE)
+        self.ammo = xp.full(self.x.shape, ammo, dtype=DTYPE)
+        self.direction = xp.asarray(direction, dtype=DTYPE)
+        self.cos_direction = xp.cos(self.direction)
+        self.sin_direction = xp.sin(self.direction)
+        self.last_action = xp.full(self.x.shape, DO_NOTHING)
+        self.moved = False      # whether any robot of the batch moved since the last sensor update
+        self.enemy_distance = xp.zeros(self.x.shape, dtype=DTYPE)
+        self.enemy_direction = xp.zeros(self.x.shape, dtype=DTYPE)
+        self.wall_distance = xp.zeros(self.x.shape, dtype=DTYPE)
+
     def update_sensors(self, opponent, arena_size):
+        xp = self.xp
+
         # Distance to opponent sensor
         dx = opponent.x - self.x
         dy = opponent.y - self.y
-        self.sensors['enemy_distance'] = math.sqrt(dx**2 + dy**2)
-        
+        self.enemy_distance = xp.hypot(dx, dy)
+
         # Direction to opponent sensor (relative to current direction)
-        enemy_dir = math.atan2(dy, dx)
-        self.sensors['enemy_direction'] = (enemy_dir - self.direction) % (2 * math.pi)
-        
-        # Health and ammo update
-        self.sensors['health'] = self.health
-        self.sensors['ammo'] = self.ammo
-        
+        enemy_dir = xp.arctan2(dy, dx)
+        self.enemy_direction = self.relative_angle(enemy_dir)
+
         # Distance to nearest wall
-        self.sensors['wall_distance'] = min(
-            self.x, arena_size - self.x, 
-            self.y, arena_size - self.y
+        self.wall_distance = xp.minimum(
+            xp.minimum(self.x, arena_size - self.x),
+            xp.minimum(self.y, arena_size - self.y)
         )
-    
+        self.moved = False
+
+    def relative_angle(self, angle):
+        # Angle in (-pi, pi] relative to the current directions, in [0, 2pi): equivalent to
+        # (angle - direction) % (2 * math.pi), but the difference is in (-3pi, pi], so adding 2pi to
+        # negative values at most twice avoids a floating-point modulo
+        xp = self.xp
+        angle = angle - self.direction
+        angle = xp.where(angle < 0, angle + TWO_PI, angle)
+        return xp.where(angle < 0, angle + TWO_PI, angle)
+
     def execute_action(self, action, opponent, arena_size):
+        xp = self.xp
+        move_distance, turn_angle, reload_ammo = self.effects
 
         self.last_action = action
-        
-        if action == 'move_forward':
-            move_dist = 5
-            new_x = self.x + move_dist * math.cos(self.direction)
-            new_y = self.y + move_dist * math.sin(self.direction)
-            
-            # Check for arena boundaries when moving
-            if 0 <= new_x <= arena_size and 0 <= new_y <= arena_size:
-                self.x = new_x
-                self.y = new_y
-        
-        # Turn left/right by 22.5 degrees
-        elif action == 'turn_left':
-            self.direction = (self.direction - math.pi/8) % (2 * math.pi)
-        
-        elif action == 'turn_right':
-            self.direction = (self.direction + math.pi/8) % (2 * math.pi)
-        
+
+        # The effects of all actions are looked up by action code and applied to every slot at once
+        # (the actions a slot does not take have null effects)
+
+        # Move forward, unless it would leave the arena
+        move_dist = move_distance[action]
+        new_x = self.x + move_dist * self.cos_direction
+        new_y = self.y + move_dist * self.sin_direction
+        move = (move_dist > 0) & (0 <= new_x) & (new_x <= arena_size) & (0 <= new_y) & (new_y <= arena_size)
+        self.x = xp.where(move, new_x, self.x)
+        self.y = xp.where(move, new_y, self.y)
+        self.moved = self.moved or bool(move.any())
+
+        # Turn left/right
+        turn = turn_angle[action] != 0
+        # (directions stay in [0, 2pi), so a turn is at most one full turn off: a conditional add or subtract of
+        # 2pi is enough, and much cheaper than a floating-point modulo)
+        direction = self.direction + turn_angle[action]
+        direction = xp.where(direction < 0, direction + TWO_PI, direction)
+        self.direction = xp.where(direction >= TWO_PI, direction - TWO_PI, direction)
+        if turn.any():
+            self.cos_direction = xp.cos(self.direction)
+            self.sin_direction = xp.sin(self.direction)
+
         # Shoot and check if the shot hit the opponent
-        elif action == 'shoot' and self.ammo > 0:
-            self.ammo -= 1
-            
+        shoot = (action == SHOOT) & (self.ammo > 0)
+        self.ammo = self.ammo - shoot
+
+        # A shooting robot neither moves nor turns, so the sensed distance and direction to the opponent
+        # still hold, unless the opponent has moved since the sensors were updated
+        if opponent.moved:
             dx = opponent.x - self.x
             dy = opponent.y - self.y
 
             # (the angle is given by atan(dy/dx))
-            angle_to_opponent = math.atan2(dy, dx)      # atan2(dy,dx) == atan(dy/dx)
-            angle_diff = abs((angle_to_opponent - self.direction) % (2 * math.pi))
-            
-            # The bullet has a shotgun-like spread (22.5 deg) and a maximum travel distance of 50
-            if angle_diff < math.pi/8 and math.sqrt(dx**2 + dy**2) < 50:
-                opponent.health -= 20
-        
-        elif action == 'reload':
-            self.ammo = min(50, self.ammo + 10)
-        
-        elif action == 'do_nothing':
-            pass
\ No newline at end of file
+            angle_to_opponent = xp.arctan2(dy, dx)      # atan2(dy,dx) == atan(dy/dx)
+            angle_diff = self.relative_angle(angle_to_opponent)
+            distance = xp.hypot(dx, dy)
+        else:
+            angle_diff = self.enemy_direction
+            distance = self.enemy_distance
+
+        # The bullet has a shotgun-like spread (22.5 deg) and a maximum travel distance of 50
+        hit = shoot & (angle_diff < math.pi/8) & (distance < 50)
+        opponent.health = xp.where(hit, opponent.health - 20, opponent.health)
+
+        # Reload
+        ammo = xp.minimum(50, self.ammo + reload_ammo[action])
+        reload = ammo != self.ammo
+        self.ammo = ammo
+
+        return move | turn | shoot | reload